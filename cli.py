@@ -23,6 +23,10 @@ parser.add_argument('--n_time_steps_per', type=int, default=1, help="number of t
 parser.add_argument('--time_epsilon', type=float, default=None, help="How long is the depth-time")
 parser.add_argument('--batch_norm', default=True, help='include batch norm layers', action='store_true')
 parser.add_argument('--use_skipinit', default=False, help='use skip init', action='store_true')
+parser.add_argument('--amp', default=False, help='train with automatic mixed precision', action='store_true')
+parser.add_argument('--amp_dtype', type=str, default='float16', choices=['float16', 'bfloat16'], help='reduced precision used by --amp (default: "float16")')
+parser.add_argument('--checkpoint', default=False, help='recompute ODE blocks on backward to save memory', action='store_true')
+parser.add_argument('--train_acc', default=False, help='also report training accuracy', action='store_true')
 parser.add_argument('--seed', type=int, default='1',  help='Seed value')
 parser.add_argument('--device', type=str, default=None, help='Which pytorch device?')
 
@@ -46,6 +50,10 @@ def drive_by_args(args):
         epoch_update = args.lr_decay_epoch,
         use_skip_init = args.use_skipinit,
         weight_decay = args.weight_decay,
+        use_amp = args.amp,
+        amp_dtype = args.amp_dtype,
+        want_train_acc = args.train_acc,
+        use_checkpoint = args.checkpoint,
         seed = args.seed,
         device = args.device)
 
@@ -23,6 +23,7 @@ class ContinuousNet(nn.Module):
                  use_skip_init=False,
                  use_stitch=True,
                  use_adjoint=False,
+                 use_checkpoint=False,
                  activation_before_conv=False):
         super().__init__()
         self.scheme = scheme
@@ -49,7 +50,8 @@ class ContinuousNet(nn.Module):
                     use_skip_init=use_skip_init),
                 n_time_steps=time_d*n_time_steps_per,
                 scheme=scheme,
-                use_adjoint=use_adjoint)
+                use_adjoint=use_adjoint,
+                use_checkpoint=use_checkpoint)
         if use_stitch:
             _stitch_macro = lambda _alpha, _beta, stride=2 : \
                 _ODEStitch(_alpha, _beta, _beta,
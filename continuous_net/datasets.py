@@ -2,7 +2,8 @@ import torch
 import torchvision
 from torchvision import datasets, transforms
 
-def get_dataset(name='FMNIST', batch_size=128, test_batch_size=256, root='.', device=None):
+def get_dataset(name='FMNIST', batch_size=128, test_batch_size=256, root='.', device=None,
+                distributed=False):
 
     if name=='CIFAR10':
         transform_train = transforms.Compose([
@@ -92,11 +93,17 @@ def get_dataset(name='FMNIST', batch_size=128, test_batch_size=256, root='.', de
     if device is not None:
         trainset = trainset.to(device)
         testnset = testset.to(device)
+    if distributed:
+        # Each rank sees its own shard; the sampler does the shuffling
+        train_sampler = torch.utils.data.DistributedSampler(trainset)
+    else:
+        train_sampler = None
     trainloader = torch.utils.data.DataLoader(
-        trainset, batch_size=batch_size, shuffle=True, num_workers=2,
-        pin_memory=True)
+        trainset, batch_size=batch_size, shuffle=train_sampler is None,
+        sampler=train_sampler, num_workers=4, pin_memory=True,
+        persistent_workers=True, prefetch_factor=4)
     testloader = torch.utils.data.DataLoader(
-        testset, batch_size=test_batch_size, shuffle=True, num_workers=2,
-        pin_memory=True)
+        testset, batch_size=test_batch_size, shuffle=True, num_workers=4,
+        pin_memory=True, persistent_workers=True, prefetch_factor=4)
 
     return refset,trainset,trainloader,testset,testloader
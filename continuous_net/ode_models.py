@@ -3,16 +3,20 @@ Time-dependent networks for RefineNet
 """
 
 import copy
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import torchdiffeq
 
 from .helper import which_device
 
 
 def piecewise_index(t, time_d):
-    t_idx = int(t*time_d)
+    # Multiply in float32 like the time grid, or grid points on a cell
+    # boundary can round down into the previous cell.
+    t_idx = int(np.float32(float(t)) * np.float32(time_d))
     if t_idx==time_d: t_idx = time_d-1
     return t_idx
 
@@ -44,8 +48,7 @@ class Conv2DODE(torch.nn.Module):
         
     def forward(self, t, x):
         # Use the trick where it's the same as index selection
-        t_idx = int(t*self.time_d)
-        if t_idx==self.time_d: t_idx = self.time_d-1
+        t_idx = piecewise_index(t, self.time_d)
         wij = self.weight[t_idx,:,:,:,:]
         bi = self.bias[t_idx,:]
         y = torch.nn.functional.conv2d(x, wij,bi, padding=self.padding)
@@ -102,6 +105,8 @@ class ShallowConv2DODE(torch.nn.Module):
                 time_d, in_features, affine=True, track_running_stats=True)
         
     def forward(self, t, x):
+        # Pull t off the device once; every sub-layer indexes with it.
+        t = float(t)
         if self.verbose: print("shallow @ ",t)
         x = self.L1(t, x)
         x = self.act(x, inplace=True)
@@ -145,6 +150,8 @@ class ShallowConv2DODE(torch.nn.Module):
 class ShallowConv2DODE_Flipped(ShallowConv2DODE):
     """Activaction-first variation of R"""
     def forward(self, t, x):
+        # Pull t off the device once; every sub-layer indexes with it.
+        t = float(t)
         if self.verbose: print("shallow @ ",t)
 
         if self.use_batch_norms==True: x = self.bn1(t,x)
@@ -337,8 +344,7 @@ class SkipInitODE(nn.Module):
         self.weight = nn.Parameter(torch.zeros(time_d).float())
 
     def forward(self, t, x):
-        t_idx = int(t*self.time_d)
-        if t_idx==self.time_d: t_idx = self.time_d-1
+        t_idx = piecewise_index(t, self.time_d)
         return self.weight[t_idx] * x
     def refine(self, variance=0.0):
         new = SkipInitODE(2*self.time_d)
@@ -350,18 +356,57 @@ class SkipInitODE(nn.Module):
 class ODEBlock(torch.nn.Module):
     """The building block of RefineNet.
 
-    Wraps an ode-model with the odesolve to fit into standard models."""
+    Wraps an ode-model with the odesolve to fit into standard models.
+
+    use_checkpoint keeps only the block input for the backward pass and
+    recomputes the stages, trading FLOPs for activation memory. The batch
+    norm running statistics are restored after the recomputation so they
+    only advance once per step.
+    """
     def __init__(self, net, n_time_steps=1, scheme='euler',
-                 use_adjoint=False):
+                 use_adjoint=False, use_checkpoint=False):
         super(ODEBlock,self).__init__()
         self.n_time_steps = n_time_steps
         self.scheme = scheme
         self.use_adjoint = use_adjoint
+        self.use_checkpoint = use_checkpoint
         # TODO: awk with piecewise constant centered on the half-cells
-        self.ts = torch.linspace(0, 1.0, self.n_time_steps+1)
+        # A buffer so the grid follows the model to its device once
+        self.register_buffer('ts', torch.linspace(0, 1.0, self.n_time_steps+1),
+                             persistent=False)
         self.net = net
         
     def forward(self,x):
+        # Blocks pickled before use_checkpoint existed don't have it
+        if getattr(self, 'use_checkpoint', False) and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(
+                self._recomputable_integrate(), x, use_reentrant=False)
+        return self._integrate(x)
+
+    def _recomputable_integrate(self):
+        """_integrate, but later calls leave the batch norm buffers as they were."""
+        bn_buffers = [
+            buf for m in self.net.modules()
+            if isinstance(m, nn.modules.batchnorm._BatchNorm)
+            for buf in m.buffers()
+        ]
+        first_call = [True]
+        def integrate(x):
+            if first_call[0]:
+                first_call[0] = False
+                return self._integrate(x)
+            # The recomputation may be stopped early by an exception once
+            # the last saved tensor is reached, so restore in a finally.
+            saved = [buf.clone() for buf in bn_buffers]
+            try:
+                return self._integrate(x)
+            finally:
+                with torch.no_grad():
+                    for buf, old in zip(bn_buffers, saved):
+                        buf.copy_(old)
+        return integrate
+
+    def _integrate(self,x):
         if self.use_adjoint:
             integ = torchdiffeq.odeint_adjoint
         else:
@@ -373,7 +418,9 @@ class ODEBlock(torch.nn.Module):
     
     def refine(self, variance=0.0):
         r_net = refine(self.net, variance)
-        new = ODEBlock(r_net, self.n_time_steps*2, scheme=self.scheme).to(which_device(self))
+        new = ODEBlock(r_net, self.n_time_steps*2, scheme=self.scheme,
+                       use_adjoint=self.use_adjoint,
+                       use_checkpoint=getattr(self, 'use_checkpoint', False)).to(which_device(self))
         return new
     
     def diffeq(self,x):
@@ -384,4 +431,4 @@ class ODEBlock(torch.nn.Module):
     
     def set_n_time_steps(self, n_time_steps):
         self.n_time_steps=n_time_steps
-        self.ts = torch.linspace(0, 1.0, self.n_time_steps+1)
+        self.ts = torch.linspace(0, 1.0, self.n_time_steps+1, device=self.ts.device)
@@ -1,14 +1,19 @@
 import numpy as np
 import collections
+import re
 from typing import List, Any
 import timeit
 import attr
 import torch
+import torch.distributed as dist
 import torch.nn.init as init
+from torch.nn.parallel import DistributedDataParallel
 
 from .helper import get_device, which_device
 from .ode_models import refine
 
+# Input shapes are fixed, so let cuDNN pick the fastest conv algorithms
+torch.backends.cudnn.benchmark = True
 
 @attr.s(auto_attribs=True)
 class Result:
@@ -43,18 +48,70 @@ def reset_lr(optimizer, lr):
     return optimizer
 
 
-@torch.no_grad()
-def calculate_accuracy(model, loader):
+# Member j of a refined BatchNorm2DODE was copied from member j//2
+_REFINED_BN = re.compile(r'(^|\.)bns\.(\d+)\.')
+
+
+def transfer_momentum(old_model, old_optimizer, new_model, new_optimizer):
+    """Warm-start the momentum of new_optimizer from before a refinement.
+
+    Parameters are matched by name. Time-dependent parameters, whose leading
+    time axis was doubled by refine, get their buffers duplicated the same
+    way the weights were. Anything without a match starts from zero.
+    """
+    old_params = dict(old_model.named_parameters())
+    for name, p in new_model.named_parameters():
+        old_name = _REFINED_BN.sub(
+            lambda m: f'{m.group(1)}bns.{int(m.group(2))//2}.', name)
+        old_p = old_params.get(old_name)
+        if old_p is None:
+            continue
+        buf = old_optimizer.state.get(old_p, {}).get('momentum_buffer')
+        if buf is None:
+            continue
+        if buf.shape == p.shape:
+            new_buf = buf.clone()
+        elif buf.shape[1:] == p.shape[1:] and 2*buf.shape[0] == p.shape[0]:
+            new_buf = buf.repeat_interleave(2, dim=0)
+        else:
+            continue
+        new_optimizer.state[p]['momentum_buffer'] = new_buf
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def wrap_distributed(model, device):
+    """Wrap model in DDP if a process group has been initialized.
+
+    The stitches own parameters that never see a gradient (ODEStitch.bn2,
+    ODEStitch_Flipped.skip_init), so DDP has to look for unused ones.
+    """
+    if not is_distributed():
+        return model
+    if device.type == 'cuda':
+        return DistributedDataParallel(model, device_ids=[device],
+                                       find_unused_parameters=True)
+    return DistributedDataParallel(model, find_unused_parameters=True)
+
+
+@torch.inference_mode()
+def calculate_accuracy(model, loader, use_amp=False, amp_dtype=torch.float16):
     device = which_device(model)
-    correct, total_num = 0, 0
+    # Count on the device and sync once at the end
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    total_num = 0
     for data, target in loader:
-        data, target = data.to(device), target.to(device)
-        output = model(data)
+        data = data.to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True)
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+            output = model(data)
         # get the index of the max log-probability
-        pred = output.data.max(1, keepdim=True)[1]
-        correct += pred.eq(target.data.view_as(pred)).cpu().sum().item()
+        pred = output.max(1, keepdim=True)[1]
+        correct += pred.eq(target.view_as(pred)).sum()
         total_num += len(data)
-    return correct / total_num
+    return correct.item() / total_num
 
 
 def train_adapt(model,
@@ -68,10 +125,21 @@ def train_adapt(model,
                 epoch_update=None,
                 weight_decay=1e-5,
                 refine_variance=0.0,
+                use_amp=False,
+                amp_dtype=torch.float16,
+                want_train_acc=False,
                 device=None,
                 fname=None,
                 SAVE_DIR=None):
-    """Adaptive Refinement Training for RefineNets"""
+    """Adaptive Refinement Training for RefineNets
+
+    use_amp runs the forward passes under autocast in amp_dtype. The
+    loss is only scaled for float16; bfloat16 has float32's range. If
+    torch.distributed has been initialized, the model is trained with
+    DistributedDataParallel and the loader is expected to use a
+    DistributedSampler; only rank 0 evaluates and reports accuracy.
+    want_train_acc also reports the running training accuracy of each epoch.
+    """
     if N_refine is None:
         N_refine = []
     if epoch_update is None:
@@ -84,66 +152,95 @@ def train_adapt(model,
     refine_steps = []
     epoch_times = []
     model_list = [model]
+    is_main_rank = not is_distributed() or dist.get_rank() == 0
     lr_current = lr
     step_count = 0
-    want_train_acc = False
 
-    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=weight_decay)
+    optimizer = torch.optim.SGD(model.parameters(), lr=lr, momentum=0.9, weight_decay=weight_decay,
+                                foreach=True)
+    # Only float16 needs loss scaling, and torch.amp.GradScaler needs torch>=2.3
+    if use_amp and amp_dtype == torch.float16:
+        scaler = torch.amp.GradScaler(device.type)
+    else:
+        scaler = None
 
-    # Uncomment to use 4 gpus
-    USE_PARALLEL = False
-    if USE_PARALLEL:
-        model_single = model
-        model = torch.nn.DataParallel(model_single, device_ids=[0,1,2,3])
+    model = wrap_distributed(model, device)
 
     for e in range(N_epochs):
         model.train()
+        # Reshuffle the shards of a DistributedSampler
+        if hasattr(loader.sampler, 'set_epoch'):
+            loader.sampler.set_epoch(e)
 
         # Make a new model if the epoch number is in the schedule
         if e in N_refine:
             # Get back from parallel
-            if USE_PARALLEL:
+            if isinstance(model, DistributedDataParallel):
                 model = model.module
+            old_model = model
             new_model = model.refine(refine_variance)
             model_list.append(new_model)
             # Make the new one parallel
-            if USE_PARALLEL:
-                model = torch.nn.DataParallel(new_model, device_ids=[0,1,2,3])
-            else:
-                model = new_model
-            print('**** Allocated refinment ****')
-            print('Total params: %.2fk' % (count_parameters(model)/1000.0))
-            print('************')
-            te_acc = calculate_accuracy(model, testloader)
-            print('Test Accuracy after refinement: ', te_acc)
-            test_acc.append( (e,te_acc) )
-            if want_train_acc:
-                tr_acc = calculate_accuracy(model, loader)
-                print('Train Accuracy after refinement: ', tr_acc)
-                train_acc.append( (e,tr_acc) )
-            print(model)
+            model = wrap_distributed(new_model, device)
+            if is_main_rank:
+                print('**** Allocated refinment ****')
+                print('Total params: %.2fk' % (count_parameters(new_model)/1000.0))
+                print('************')
+                # Evaluate the unwrapped model so DDP issues no collectives
+                te_acc = calculate_accuracy(new_model, testloader, use_amp, amp_dtype)
+                print('Test Accuracy after refinement: ', te_acc)
+                test_acc.append( (e,te_acc) )
+                if want_train_acc:
+                    tr_acc = calculate_accuracy(new_model, loader, use_amp, amp_dtype)
+                    print('Train Accuracy after refinement: ', tr_acc)
+                    train_acc.append( (e,tr_acc) )
+                print(new_model)
             # We need to reset the optimizer to point to the new weights
-            optimizer = torch.optim.SGD(model.parameters(), lr=lr_current, momentum=0.9, weight_decay=weight_decay)
+            old_optimizer = optimizer
+            optimizer = torch.optim.SGD(model.parameters(), lr=lr_current, momentum=0.9, weight_decay=weight_decay,
+                                        foreach=True)
+            transfer_momentum(old_model, old_optimizer, new_model, optimizer)
             refine_steps.append(step_count)
 
         starting_time = timeit.default_timer()
         # Train one epoch over the new model
         model.train()
+        # Keep the losses on the device and sync once per epoch
+        epoch_losses = []
+        if want_train_acc:
+            train_correct = torch.zeros((), dtype=torch.long, device=device)
+            train_total = 0
         for imgs,labels in iter(loader):
-            imgs = imgs.to(device)
-            labels = labels.to(device)
-            out = model(imgs)
-            L = criterion(out,labels)
-            L.backward()
-            optimizer.step()
-            optimizer.zero_grad()
-            if torch.isnan(L):
-                print("Hit a NaN, returning early.")
-                return Result(model_list, losses, refine_steps, train_acc, test_acc, epoch_times)
-            _loss = L.detach().cpu().item()
-            losses.append(_loss)
+            imgs = imgs.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
+                out = model(imgs)
+                L = criterion(out,labels)
+            if scaler is not None:
+                scaler.scale(L).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                L.backward()
+                optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            epoch_losses.append(L.detach())
+            if want_train_acc:
+                # Running accuracy from the training forward pass
+                train_correct += (out.detach().argmax(1) == labels).sum()
+                train_total += labels.size(0)
             step_count+=1
+        epoch_losses = torch.stack(epoch_losses)
+        # Every rank has to agree to stop, or the others hang in all-reduce
+        hit_nan = torch.isnan(epoch_losses).any().int()
+        if is_distributed():
+            dist.all_reduce(hit_nan, op=dist.ReduceOp.MAX)
+        epoch_losses = epoch_losses.cpu()
+        losses.extend(epoch_losses.tolist())
         epoch_times.append(timeit.default_timer() - starting_time)
+        if hit_nan.item():
+            print("Hit a NaN, returning early.")
+            return Result(model_list, losses, refine_steps, train_acc, test_acc, epoch_times)
         #print("Epoch took ", epoch_times[-1], " seconds.")
 
 
@@ -151,14 +248,15 @@ def train_adapt(model,
 
         # Evaluate training and testing accuracy
         n_print = 5
-        if e == 0 or (e+1) % n_print == 0:
+        if is_main_rank and (e == 0 or (e+1) % n_print == 0):
             print('After Epoch: ', e+1)
-            model.eval()
+            eval_model = model.module if isinstance(model, DistributedDataParallel) else model
+            eval_model.eval()
             if want_train_acc:
-                tr_acc = calculate_accuracy(model, loader)
+                tr_acc = train_correct.item() / train_total
                 print('Train Accuracy: ', tr_acc)
                 train_acc.append( (e,tr_acc) )
-            te_acc = calculate_accuracy(model, testloader)
+            te_acc = calculate_accuracy(eval_model, testloader, use_amp, amp_dtype)
             print('Test Accuracy: ', te_acc)
             test_acc.append( (e,te_acc) )
         # Save checkpoint
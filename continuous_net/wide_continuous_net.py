@@ -24,6 +24,7 @@ class WideContinuousNet(nn.Module):
                  use_skip_init=False,
                  use_stitch=True,
                  use_adjoint=False,
+                 use_checkpoint=False,
                  activation_before_conv=True):
         super().__init__()
         self.scheme = scheme
@@ -50,7 +51,8 @@ class WideContinuousNet(nn.Module):
                     use_skip_init=use_skip_init),
                 n_time_steps=time_d*n_time_steps_per,
                 scheme=scheme,
-                use_adjoint=use_adjoint)
+                use_adjoint=use_adjoint,
+                use_checkpoint=use_checkpoint)
         if use_stitch:
             _stitch_macro = lambda _alpha, _beta, stride=2 : \
                 _ODEStitch(_alpha, _beta, _beta,
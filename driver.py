@@ -4,6 +4,7 @@ from matplotlib import pylab as plt
 import numpy as np
 
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.init as init
 
@@ -39,8 +40,12 @@ def do_a_train_set(
     batch_size = 128,
     test_batch_size = 512,
     use_adjoint=False,
+    use_checkpoint=False,
     use_skip_init=False,
     refine_variance=0.0,
+    use_amp=False,
+    amp_dtype='float16',
+    want_train_acc=False,
     seed=1,
     device=None):
     """Set up and train one model, and save it.
@@ -56,9 +61,22 @@ def do_a_train_set(
         epoch_update: A list of epochs at which to call a learning_rate schedule
         weight_decay: Traditional weight decay parameter
         use_adjoint: Use the adjoint method for backpropogation
+        use_checkpoint: Recompute the ODE blocks on the backward pass to save memory
+        use_amp: Train and evaluate with automatic mixed precision
+        amp_dtype: Reduced precision for use_amp, "float16" or "bfloat16"
+        want_train_acc: Also report training accuracy
         seed: a seed
         device: which device to use
+
+    When launched with torchrun (LOCAL_RANK is set), one process trains per
+    GPU with DistributedDataParallel and only rank 0 writes the results.
     """
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        dist.init_process_group(backend='nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        device = f'cuda:{local_rank}'
 
     fname = SAVE_DIR+f'/continuousnet-{dataset}-{which_model}-{scheme}-{initial_time_d}-{n_time_steps_per}-{N_epochs}-{N_adapt}-{refine_variance}-{"Adjoint" if use_adjoint else "Backprop"}-SEED-{seed}.pkl'
 
@@ -69,8 +87,14 @@ def do_a_train_set(
     if time_epsilon is None:
         time_epsilon = initial_time_d
 
+    # Let rank 0 download the dataset before the other ranks read it
+    if distributed and dist.get_rank() != 0:
+        dist.barrier()
     refset,trainset,trainloader,testset,testloader = \
-        datasets.get_dataset(dataset,root='../data/', batch_size=batch_size, test_batch_size=test_batch_size)
+        datasets.get_dataset(dataset,root='../data/', batch_size=batch_size, test_batch_size=test_batch_size,
+                             distributed=distributed)
+    if distributed and dist.get_rank() == 0:
+        dist.barrier()
 
     if dataset=="CIFAR10":
         out_classes = 10
@@ -97,6 +121,7 @@ def do_a_train_set(
             n_time_steps_per=n_time_steps_per,
             use_skip_init=use_skip_init,
             use_adjoint=use_adjoint,
+            use_checkpoint=use_checkpoint,
             activation_before_conv=False,
         ).to(device)
     elif which_model == "ContinuousNetActFirst":
@@ -111,6 +136,7 @@ def do_a_train_set(
             n_time_steps_per=n_time_steps_per,
             use_skip_init=use_skip_init,
             use_adjoint=use_adjoint,
+            use_checkpoint=use_checkpoint,
             activation_before_conv=True,
         ).to(device)
     elif which_model == "WideContinuousNet":
@@ -126,6 +152,7 @@ def do_a_train_set(
             n_time_steps_per=n_time_steps_per,
             use_skip_init=use_skip_init,
             use_adjoint=use_adjoint,
+            use_checkpoint=use_checkpoint,
             activation_before_conv=True,
         ).to(device)
 
@@ -143,9 +170,17 @@ def do_a_train_set(
         model, trainloader, testloader, torch.nn.CrossEntropyLoss(),
         N_epochs, N_adapt, lr=lr, lr_decay=lr_decay, epoch_update=epoch_update, weight_decay=weight_decay,
         refine_variance=refine_variance,
+        use_amp=use_amp,
+        amp_dtype=getattr(torch, amp_dtype),
+        want_train_acc=want_train_acc,
         device=device,
         SAVE_DIR=SAVE_DIR, fname=fname)
 
+    if distributed:
+        is_main_rank = dist.get_rank() == 0
+        dist.destroy_process_group()
+        if not is_main_rank:
+            return res
     try:
         os.mkdir(SAVE_DIR)
         print("Making directory ", "results.")
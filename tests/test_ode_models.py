@@ -0,0 +1,33 @@
+import copy
+import torch
+
+from continuous_net.ode_models import ODEBlock, ShallowConv2DODE
+
+
+def _bn_buffers(block):
+    return [
+        buf for m in block.modules()
+        if isinstance(m, torch.nn.BatchNorm2d)
+        for buf in m.buffers()
+    ]
+
+
+def test_checkpointed_block_updates_batch_norm_stats_once():
+    torch.manual_seed(0)
+    plain = ODEBlock(
+        ShallowConv2DODE(2, 4, 4, use_batch_norms=True),
+        n_time_steps=2, scheme='euler')
+    checkpointed = copy.deepcopy(plain)
+    checkpointed.use_checkpoint = True
+    plain.train()
+    checkpointed.train()
+
+    x = torch.randn(3, 4, 8, 8)
+    plain(x).sum().backward()
+    checkpointed(x).sum().backward()
+
+    for m in checkpointed.modules():
+        if isinstance(m, torch.nn.BatchNorm2d):
+            assert m.num_batches_tracked.item() == 1
+    for ref, buf in zip(_bn_buffers(plain), _bn_buffers(checkpointed)):
+        assert torch.allclose(ref.float(), buf.float())